@@ -17,34 +17,97 @@ quite resource intensive, and Homebrew might hit GitHub's API calls quota.
 
 from __future__ import print_function, unicode_literals
 
+import errno
 import json
 import os
-import re
 import sys
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from operator import methodcaller
 from subprocess import PIPE, Popen, call
+from tempfile import TemporaryFile
+from threading import Lock
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2 has no LRU cache: do without memoization.
+    def lru_cache(maxsize=128):
+        return lambda func: func
+
+# Use the fastest JSON parser available.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    try:
+        from ujson import loads as _json_loads
+    except ImportError:
+        from json import loads as _json_loads
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 can only intern byte strings, while ours are all unicode.
+    def intern(string):
+        return string
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2.
+    def which(name):
+        """ Return the absolute path of an executable found in the PATH.
+
+        Relative entries of the PATH are ignored so the current directory is
+        never searched.
+        """
+        for folder in os.environ.get('PATH', '').split(os.pathsep):
+            if not os.path.isabs(folder):
+                continue
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        return None
 
 # macOS does not put /usr/local/bin or /opt/local/bin in the PATH for GUI apps.
 # For some package managers this is a problem. Additioanlly Homebrew and
 # Macports are using different pathes.  So, to make sure we can always get to
 # the necessary binaries, we overload the path.  Current preference order would
-# equate to Homebrew, Macports, then System.
+# equate to Homebrew (Intel then Apple Silicon), Macports, then System.
 os.environ['PATH'] = ':'.join(['/usr/local/bin',
                                '/usr/local/sbin',
+                               '/opt/homebrew/bin',
+                               '/opt/homebrew/sbin',
                                '/opt/local/bin',
                                '/opt/local/sbin',
                                os.environ.get('PATH', '')])
 
+# Where to persist data between runs of the plugin.
+CACHE_DIR = os.path.expanduser('~/Library/Caches/bitbar-mpm')
+
+# An available package update.
+Update = namedtuple('Update', 'name installed_version latest_version')
+
 
 class PackageManager(object):
     """ Generic class for a package manager. """
 
-    cli = None
+    # Name of the main CLI, searched in the PATH.
+    cli_name = None
+
+    # Environment to run the CLI in. Defaults to the current one.
+    env = None
 
     def __init__(self):
         # List all available updates and their versions.
         self.updates = []
         self.error = None
+        self._update_cli_template = None
+        self._active = None
+        # CLI calling back this script to upgrade all packages of the manager.
+        self._update_all_cmd = '{} upgrade {}'.format(
+            sys.argv[0], self.__class__.__name__)
 
     @property
     def name(self):
@@ -52,34 +115,92 @@ class PackageManager(object):
         """
         return self.__class__.__name__
 
+    @property
+    def cli(self):
+        """ Return the absolute path to the main CLI, or None if not found.
+
+        The PATH is searched once per class.
+        """
+        klass = self.__class__
+        if '_cli' not in klass.__dict__:
+            path = which(klass.cli_name) if klass.cli_name else None
+            klass._cli = intern(path) if path else None
+        return klass._cli
+
     @property
     def active(self):
         """ Is the package manager available on the system?
 
-        Returns True is the main CLI exists and is executable.
+        Result of ``_check_active()`` is computed once per instance.
         """
-        return os.path.isfile(self.cli) and os.access(self.cli, os.X_OK)
+        if self._active is None:
+            self._active = self._check_active()
+        return self._active
+
+    def _check_active(self):
+        """ Returns True is the main CLI exists and is executable. """
+        return self.cli is not None
 
     def run(self, *args):
         """ Run a shell command, return the output and keep error message.
         """
         self.error = None
         process = Popen(
-            args, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+            args, stdout=PIPE, stderr=PIPE, universal_newlines=True,
+            env=self.env)
         output, error = process.communicate()
+        # Python 2 returns bytes despite universal_newlines.
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        if isinstance(error, bytes):
+            error = error.decode('utf-8')
         if process.returncode != 0 and error:
-            self.error = error.decode('utf-8')
-        return output.decode('utf-8')
+            self.error = error
+        return output
+
+    def run_json(self, *args):
+        """ Run a shell command and parse its JSON output.
+
+        Returns None if the command produced no parseable output. Error
+        messages are kept the same way as in ``run()``.
+        """
+        self.error = None
+        # Buffer stderr in a file so a chatty command can't block on a full
+        # pipe while we are still reading its stdout.
+        with TemporaryFile() as stderr:
+            process = Popen(
+                args, stdout=PIPE, stderr=stderr, universal_newlines=True,
+                env=self.env)
+            try:
+                data = _json_loads(process.stdout.read())
+            except ValueError:
+                data = None
+            process.stdout.close()
+            process.wait()
+            if process.returncode != 0:
+                stderr.seek(0)
+                error = stderr.read().decode('utf-8')
+                if error:
+                    self.error = error
+        return data
 
     def sync(self):
         """ Fetch latest versions of installed packages.
 
-        Returns a list of dict with package name, current installed version and
-        latest upgradeable version.
+        Fills ``updates`` with an ``Update`` per package, holding its name,
+        current installed version and latest upgradeable version.
         """
         raise NotImplementedError
 
+    def cached_sync(self):
+        """ Sync the manager, reusing previous results if possible.
+
+        Managers without a disk cache always sync from scratch.
+        """
+        self.sync()
+
     @staticmethod
+    @lru_cache(maxsize=None)
     def bitbar_cli_format(full_cli):
         """ Format a bash-runnable full-CLI with parameters into bitbar schema.
         """
@@ -89,24 +210,157 @@ class PackageManager(object):
             bitbar_cli += " param{}={}".format(index + 1, param)
         return bitbar_cli
 
+    def update_cli_template(self):
+        """ Return a bitbar-compatible full-CLI to update a package.
+
+        The package name is left as a ``%s`` placeholder.
+        """
+        raise NotImplementedError
+
     def update_cli(self, package_name):
         """ Return a bitbar-compatible full-CLI to update a package. """
-        raise NotImplementedError
+        # Format the command once, then only interpolate package names.
+        if self._update_cli_template is None:
+            self._update_cli_template = self.update_cli_template()
+        return self._update_cli_template % package_name
 
     def update_all_cli(self):
         """ Return a bitbar-compatible full-CLI to update all packages. """
         raise NotImplementedError
 
-    def _update_all_cmd(self):
-        return '{} upgrade {}'.format(sys.argv[0], self.__class__.__name__)
-
     def update_all_cmd(self):
         pass
 
 
-class Homebrew(PackageManager):
+class CachedPackageManager(object):
+    """ Mixin persisting the results of ``sync()`` on disk between runs.
+
+    Cached results are reused as long as they are younger than ``cache_ttl``
+    and the modification times of the CLI and of ``cache_fingerprint_paths``
+    are unchanged. These paths are expected to be touched by any install or
+    upgrade of a package. If none of them exist, nothing is cached.
+
+    The cache is made of two JSON lines: a header with the format version,
+    fingerprint and timestamp, then the list of updates. Only the header has
+    to be decoded to decide if the cache is still valid.
+    """
+
+    # Version of the cache layout. Bump it on any change to the format.
+    cache_version = 2
+
+    cache_fingerprint_paths = ()
+
+    # Maximum age of cached results, in seconds.
+    cache_ttl = 60 * 60
+
+    @property
+    def cache_path(self):
+        return os.path.join(
+            CACHE_DIR, '{}.json'.format(self.__class__.__name__))
+
+    def fingerprint(self):
+        """ Return modification times of the CLI and of tracked paths. """
+        mtimes = []
+        for path in (self.cli, ) + tuple(self.cache_fingerprint_paths):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def load_cache(self, fingerprint):
+        """ Load updates from the cache. Returns True if it was still valid.
+        """
+        try:
+            with open(self.cache_path) as cache_file:
+                header = _json_loads(cache_file.readline())
+                if header.get('version') != self.cache_version:
+                    return False
+                age = time.time() - header['ts']
+                if header['fingerprint'] != fingerprint or not (
+                        0 <= age < self.cache_ttl):
+                    return False
+                self.updates = [
+                    Update(*row) for row in _json_loads(cache_file.readline())]
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError):
+            return False
+        return True
+
+    def dump_cache(self, fingerprint):
+        """ Save current updates to the cache. Failures are ignored. """
+        try:
+            # Managers are synced in parallel and may race to create it.
+            try:
+                os.makedirs(CACHE_DIR)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            with open(self.cache_path, 'w') as cache_file:
+                cache_file.write(json.dumps({
+                    'version': self.cache_version,
+                    'fingerprint': fingerprint,
+                    'ts': time.time()}) + '\n')
+                cache_file.write(json.dumps(self.updates) + '\n')
+        except (IOError, OSError):
+            pass
+
+    def cached_sync(self):
+        fingerprint = self.fingerprint()
+        # Without any tracked path, upgrades would go unnoticed.
+        if all(mtime is None for mtime in fingerprint[1:]):
+            self.sync()
+            return
+        if self.load_cache(fingerprint):
+            return
+        self.sync()
+        # Do not keep results of a failed sync.
+        if not self.error:
+            self.dump_cache(fingerprint)
+
+
+class Homebrew(CachedPackageManager, PackageManager):
 
-    cli = '/usr/local/bin/brew'
+    cli_name = 'brew'
+
+    @property
+    def cache_fingerprint_paths(self):
+        """ Symlinks to the current version of each formula, living in the
+        ``opt`` folder of brew's prefix, are rewritten on upgrade.
+        """
+        prefix = os.path.dirname(os.path.dirname(self.cli))
+        return (os.path.join(prefix, 'opt'), )
+
+    # Spare brew its own auto-update and analytics reporting on each call.
+    # Updates are triggered explicitly by update_in_background().
+    env = dict(
+        os.environ,
+        HOMEBREW_NO_AUTO_UPDATE='1',
+        HOMEBREW_NO_ANALYTICS='1',
+        HOMEBREW_NO_INSTALL_CLEANUP='1')
+
+    # Background update is shared by all Homebrew-based managers.
+    _update_lock = Lock()
+    _update_started = False
+
+    def update_in_background(self):
+        """ Start a ``brew update`` without waiting for its completion.
+
+        `brew outdated` compares against the formulas fetched by the previous
+        update, so the new ones will be taken into account on next run. The
+        update runs in its own session to survive the end of the plugin.
+        """
+        with Homebrew._update_lock:
+            if Homebrew._update_started:
+                return
+            Homebrew._update_started = True
+        if sys.version_info >= (3, 2):
+            detach = {'start_new_session': True}
+        else:
+            detach = {'preexec_fn': os.setsid}
+        with open(os.devnull, 'wb') as devnull:
+            Popen([self.cli, 'update'], stdout=devnull, stderr=devnull,
+                  env=self.env, **detach)
 
     def sync(self):
         """ Fetch latest Homebrew formulas.
@@ -138,65 +392,114 @@ class Homebrew(PackageManager):
               }
             ]
         """
-        self.run(self.cli, 'update')
+        self.update_in_background()
 
         # List available updates.
-        output = self.run(self.cli, 'outdated', '--json=v1')
-        if not output:
+        outdated = self.run_json(self.cli, 'outdated', '--json=v1')
+        if not outdated:
             return
 
-        for pkg_info in json.loads(output):
-            self.updates.append({
-                'name': pkg_info['name'],
-                # Only keeps the highest installed version.
-                'installed_version': max(pkg_info['installed_versions']),
-                'latest_version': pkg_info['current_version']})
-
-    def update_cli(self, package_name=None):
-        cmd = "{} upgrade --cleanup".format(self.cli)
-        if package_name:
-            cmd += " {}".format(package_name)
-        return self.bitbar_cli_format(cmd)
+        for pkg_info in outdated:
+            # Skip entries not following the expected layout.
+            try:
+                update = Update(
+                    pkg_info['name'],
+                    # Only keeps the highest installed version.
+                    max(pkg_info['installed_versions']),
+                    pkg_info['current_version'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.updates.append(update)
+
+    def update_cli_template(self):
+        return self.bitbar_cli_format(
+            "{} upgrade --cleanup %s".format(self.cli))
 
     def update_all_cli(self):
-        return self.update_cli()
+        return self.bitbar_cli_format("{} upgrade --cleanup".format(self.cli))
 
 
 class HomebrewCask(Homebrew):
 
-    @property
-    def active(self):
-        """ Cask depends on vanilla Homebrew. """
-        if super(HomebrewCask, self).active:
-            cask = Popen([self.cli, 'cask'], stdout=PIPE, stderr=PIPE)
-            cask.communicate()
-            return cask.returncode == 0
-        return False
+    CASKROOMS = ('/usr/local/Caskroom', '/opt/homebrew/Caskroom')
+
+    # Support of `brew outdated --cask --json=v2`, detected on first sync.
+    _has_json_v2 = None
+
+    def _check_active(self):
+        """ Cask depends on vanilla Homebrew and creates its Caskroom. """
+        return super(HomebrewCask, self)._check_active() and any(
+            os.path.isdir(path) for path in self.CASKROOMS)
+
+    def cached_sync(self):
+        """ Always sync casks from scratch.
+
+        Upgrades only touch per-cask directories within the Caskroom, so no
+        cheap fingerprint can tell a cached result is outdated. Syncing also
+        detects which brew commands are available to update casks.
+        """
+        self.sync()
 
     def sync(self):
         """ Fetch latest formulas and their metadata.
 
+        Sample of brew output:
+
+            $ brew outdated --cask --greedy --json=v2
+            {
+              "formulae": [],
+              "casks": [
+                {
+                  "name": "firefox",
+                  "installed_versions": [
+                    "49.0.1"
+                  ],
+                  "current_version": "50.0.1"
+                }
+              ]
+            }
+        """
+        # `brew cask update` is just an alias to `brew update`, so share the
+        # one started for vanilla Homebrew.
+        self.update_in_background()
+
+        if HomebrewCask._has_json_v2 is not False:
+            outdated = self.run_json(
+                self.cli, 'outdated', '--cask', '--greedy', '--json=v2')
+            HomebrewCask._has_json_v2 = outdated is not None
+            if outdated is not None:
+                try:
+                    casks = outdated.get('casks', [])
+                except AttributeError:
+                    casks = []
+                for pkg_info in casks:
+                    # Skip entries not following the expected layout.
+                    try:
+                        name = pkg_info['name']
+                        installed = pkg_info['installed_versions']
+                        latest_version = pkg_info['current_version']
+                    except (KeyError, TypeError):
+                        continue
+                    # Older brew reports a single installed version string.
+                    if isinstance(installed, list):
+                        installed = installed[-1] if installed else '?'
+                    self.updates.append(
+                        Update(name, installed, latest_version))
+                return
+            self.error = None
+
+        self.sync_legacy()
+
+    def sync_legacy(self):
+        """ Fetch latest formulas with brew versions lacking JSON v2 output.
+
         Sample of brew cask output:
 
-            $ brew cask list --versions
-            aerial 1.2beta5
-            android-file-transfer latest
-            audacity 2.1.2
-            bitbar 1.9.2
-            firefox 49.0.1
-            flux 37.7
-            gimp 2.8.18-x86_64
-            java 1.8.0_112-b16
-
-            $ brew cask info aerial
-            aerial: 1.2beta5
-            https://github.com/JohnCoates/Aerial
-            /usr/local/Caskroom/aerial/1.2beta5 (18 files, 6.6M)
-            From: https://github.com/caskroom/homebrew-cask/blob/master/Casks/aerial.rb
-            ==> Name
-            Aerial Screensaver
-            ==> Artifacts
-            Aerial.saver (screen_saver)
+            $ brew cask outdated --greedy --verbose
+            aerial (1.2beta5) != 1.2beta6
+            android-file-transfer (latest) != latest
+            firefox (49.0.1) != 50.0.1
+            java (1.8.0_112-b16, 1.8.0_102-b14) != 1.8.0_121-b13
 
             $ brew cask info firefox
             firefox: 50.0.1
@@ -208,76 +511,88 @@ class HomebrewCask(Homebrew):
             ==> Artifacts
             Firefox.app (app)
 
-            $ brew cask info prey
-            prey: 1.6.3
-            https://preyproject.com/
-            Not installed
-            From: https://github.com/caskroom/homebrew-cask/blob/master/Casks/prey.rb
-            ==> Name
-            Prey
-            ==> Artifacts
-            prey-mac-1.6.3-x86.pkg (pkg)
-            ==> Caveats
-            Prey requires your API key, found in the bottom-left corner of
-            the Prey web account Settings page, to complete installation.
-            The API key may be set as an environment variable as follows:
-
-              API_KEY="abcdef123456" brew cask install prey
-
-            $ brew cask info ubersicht
-            ubersicht: 1.0.44
-            http://tracesof.net/uebersicht/
-            Not installed
-            From: https://github.com/caskroom/homebrew-cask/blob/master/Casks/ubersicht.rb
-            ==> Name
-            Übersicht
-            ==> Artifacts
-            Übersicht.app (app)
+            $ brew cask info --json=v1 aerial firefox
+            [{"token": "aerial", "version": "1.2beta5", ...},
+             {"token": "firefox", "version": "50.0.1", ...}]
         """
-        # `brew cask update` is just an alias to `brew update`. Perform the
-        # action anyway to make it future proof.
-        self.run(self.cli, 'cask', 'update')
-
-        # List installed packages.
-        output = self.run(self.cli, 'cask', 'list', '--versions')
-
-        # Inspect package one by one as `brew cask list` is not reliable. See:
-        # https://github.com/caskroom/homebrew-cask/blob/master/doc
-        # /reporting_bugs/brew_cask_list_shows_wrong_information.md
-        for installed_pkg in output.strip().split('\n'):
-            if not installed_pkg:
-                continue
-            infos = installed_pkg.split(' ', 1)
-            name = infos[0]
-
-            # Use heuristics to guess installed version.
-            versions = infos[1] if len(infos) > 1 else ''
-            versions = sorted([
-                v.strip() for v in versions.split(',') if v.strip()])
-            if len(versions) > 1 and 'latest' in versions:
-                versions.remove('latest')
-            version = versions[-1] if versions else '?'
-
-            # TODO: Support packages removed from repository (reported with a
-            # `(!)` flag). See: https://github.com/caskroom/homebrew-cask/blob
-            # /master/doc/reporting_bugs
-            # /uninstall_wrongly_reports_cask_as_not_installed.md
+        # Only list outdated packages, including those updating themselves.
+        output = self.run(
+            self.cli, 'cask', 'outdated', '--greedy', '--verbose')
 
-            # Inspect the package closer to evaluate its state.
-            output = self.run(self.cli, 'cask', 'info', name)
+        outdated = []
+        for outdated_pkg in output.strip().split('\n'):
+            if not outdated_pkg:
+                continue
+            name, _, infos = outdated_pkg.partition(' (')
+            versions, sep, latest_version = infos.partition(') != ')
+            if not sep:
+                versions = versions.rstrip(')')
+
+            # Use heuristics to guess installed version: keep the highest
+            # one, and only fall back to `latest` if there is nothing else.
+            version = ''
+            has_latest = False
+            for token in versions.split(','):
+                token = token.strip()
+                if token == 'latest':
+                    has_latest = True
+                elif token > version:
+                    version = token
+            version = version or ('latest' if has_latest else '?')
+
+            outdated.append((name, version, latest_version or None))
+
+        # Inspect packages whose latest version was not reported.
+        missing = [name for name, _, latest in outdated if latest is None]
+        latest_versions = self.latest_versions(missing) if missing else {}
+
+        for name, version, latest_version in outdated:
+            if latest_version is None:
+                latest_version = latest_versions.get(name)
+
+            # Skip already installed and unknown packages.
+            if latest_version is None or version == latest_version:
+                continue
 
-            latest_version = output.split('\n')[0].split(' ')[1]
+            self.updates.append(Update(name, version, latest_version))
+
+    def latest_versions(self, names):
+        """ Return a dict mapping cask names to their latest version. """
+        # Query all casks at once. Older versions of brew have no JSON output.
+        casks = self.run_json(self.cli, 'cask', 'info', '--json=v1', *names)
+        if casks:
+            versions = {}
+            for cask in casks:
+                # Skip entries not following the expected layout.
+                try:
+                    versions[cask['token']] = cask['version']
+                except (KeyError, TypeError):
+                    continue
+            return versions
 
-            # Skip already installed packages.
-            if version == latest_version:
-                continue
+        self.error = None
+        pool = ThreadPool(8)
+        try:
+            return dict(zip(names, pool.map(self.info_version, names)))
+        finally:
+            pool.close()
+            pool.join()
 
-            self.updates.append({
-                'name': name,
-                'installed_version': version,
-                'latest_version': latest_version})
+    def info_version(self, name):
+        """ Return the latest version of a cask from ``brew cask info``.
 
-    def update_cli(self, package_name):
+        Returns None if the cask can't be inspected.
+        """
+        process = Popen([self.cli, 'cask', 'info', name],
+                        stdout=PIPE, stderr=PIPE, universal_newlines=True,
+                        env=self.env)
+        output, _ = process.communicate()
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        infos = output.split('\n', 1)[0].split(' ')
+        return infos[1] if len(infos) > 1 else None
+
+    def update_cli_template(self):
         """ Install a package.
 
         TODO: wait for https://github.com/caskroom/homebrew-cask/issues/22647
@@ -285,20 +600,35 @@ class HomebrewCask(Homebrew):
         Homebrew.
         """
         return self.bitbar_cli_format(
-            "{} cask reinstall {}".format(self.cli, package_name))
+            "{} {} %s".format(self.cli, ' '.join(self.reinstall_args())))
 
     def update_all_cli(self):
         """ Cask has no way to update all outdated packages.
 
         See: https://github.com/caskroom/homebrew-cask/issues/4678
         """
-        return self.bitbar_cli_format(self._update_all_cmd())
+        return self.bitbar_cli_format(self._update_all_cmd)
 
     def update_all_cmd(self):
+        # Reinstall from fresh cask definitions: update synchronously, and keep
+        # sync() from starting a concurrent update in the background.
+        with Homebrew._update_lock:
+            Homebrew._update_started = True
+        self.run(self.cli, 'update')
         self.sync()
-        for package in self.updates:
-            call("{} cask reinstall {}".format(self.cli, package['name']),
-                 shell=True)
+        names = [package.name for package in self.updates]
+        if names:
+            call([self.cli] + self.reinstall_args() + names, env=self.env)
+
+    def reinstall_args(self):
+        """ Return brew arguments to reinstall casks.
+
+        Brew versions with JSON v2 output have dropped the `brew cask`
+        subcommands. Relies on the detection performed by ``sync()``.
+        """
+        if HomebrewCask._has_json_v2:
+            return ['reinstall', '--cask']
+        return ['cask', 'reinstall']
 
 
 class Pip(PackageManager):
@@ -321,13 +651,20 @@ class Pip(PackageManager):
         if not output:
             return
 
-        regexp = re.compile(r'(\S+) \((.*)\) - Latest: (\S+)')
         for outdated_pkg in output.split('\n'):
             if not outdated_pkg:
                 continue
 
-            name, installed_info, latest_version = regexp.match(
-                outdated_pkg).groups()
+            # Skip lines not following the expected layout.
+            try:
+                name, installed_info = outdated_pkg.split(' (', 1)
+                installed_info, sep, latest_info = installed_info.partition(
+                    ') - Latest: ')
+                latest_version = latest_info.split(' ', 1)[0]
+            except ValueError:
+                continue
+            if not sep or not latest_version:
+                continue
 
             # Extract current non-standard location if found.
             installed_info = installed_info.split(',', 1)
@@ -335,14 +672,16 @@ class Pip(PackageManager):
             special_location = " ({})".format(
                 installed_info[1].strip()) if len(installed_info) > 1 else ''
 
-            self.updates.append({
-                'name': name + special_location,
-                'installed_version': version,
-                'latest_version': latest_version})
+            self.updates.append(Update(
+                name + special_location, version, latest_version))
 
-    def update_cli(self, package_name):
+    def update_cli_template(self):
         return self.bitbar_cli_format(
-            "{} install --upgrade {}".format(self.cli, package_name))
+            "{} install --upgrade %s".format(self.cli))
+
+    def update_cli(self, package_name):
+        # Strip non-standard location appended to the name by sync().
+        return super(Pip, self).update_cli(package_name.split(' ', 1)[0])
 
     def update_all_cli(self):
         """ Produce a long CLI with all upgradeable package names.
@@ -350,40 +689,57 @@ class Pip(PackageManager):
         This work around the lack of proper full upgrade command in Pip.
         See: https://github.com/pypa/pip/issues/59
         """
-        return self.bitbar_cli_format(self._update_all_cmd())
+        return self.bitbar_cli_format(self._update_all_cmd)
 
     def update_all_cmd(self):
         self.sync()
-        for package in self.updates:
-            call("{} install -U {}".format(self.cli, package["name"]),
-                 shell=True)
+        # Strip non-standard locations appended to names by sync().
+        names = [package.name.split(' ', 1)[0] for package in self.updates]
+        if names:
+            call([self.cli, 'install', '-U'] + names)
 
 
 class Pip2(Pip):
 
-    cli = '/usr/local/bin/pip2'
+    cli_name = 'pip2'
 
-    @property
-    def name(self):
-        return "Python 2 pip"
+    name = intern("Python 2 pip")
 
 
 class Pip3(Pip):
 
-    cli = '/usr/local/bin/pip3'
+    cli_name = 'pip3'
 
-    @property
-    def name(self):
-        return "Python 3 pip"
+    name = intern("Python 3 pip")
 
 
-class NPM(PackageManager):
+class NPM(CachedPackageManager, PackageManager):
 
-    cli = '/usr/local/bin/npm'
+    cli_name = 'npm'
 
     @property
-    def name(self):
-        return "npm"
+    def cache_fingerprint_paths(self):
+        """ Global packages are installed next to npm itself.
+
+        The CLI is usually a symlink to
+        ``<prefix>/lib/node_modules/npm/bin/npm-cli.js``, whether npm comes
+        from Homebrew, nvm, volta or asdf.
+        """
+        paths = []
+        for cli in (self.cli, os.path.realpath(self.cli)):
+            folder = os.path.dirname(cli)
+            while os.path.basename(folder) not in ('node_modules', ''):
+                folder = os.path.dirname(folder)
+            if not os.path.basename(folder):
+                # Not within node_modules: look for it from the prefix.
+                folder = os.path.join(
+                    os.path.dirname(os.path.dirname(cli)),
+                    'lib', 'node_modules')
+            if folder not in paths:
+                paths.append(folder)
+        return tuple(paths)
+
+    name = intern("npm")
 
     def sync(self):
         """
@@ -405,82 +761,80 @@ class NPM(PackageManager):
               }
             }
         """
-        output = self.run(
+        outdated = self.run_json(
             self.cli, '-g', '--progress=false', '--json', 'outdated')
-        if not output:
+        if not outdated:
+            return
+
+        try:
+            packages = outdated.items()
+        except AttributeError:
             return
 
-        for package, values in json.loads(output).iteritems():
-            if values['wanted'] == 'linked':
+        for package, values in packages:
+            # Skip entries not following the expected layout.
+            try:
+                if values.get('wanted') == 'linked':
+                    continue
+                update = Update(
+                    package, values.get('current', ''), values['latest'])
+            except (KeyError, TypeError, AttributeError):
                 continue
-            self.updates.append({
-                'name': package,
-                'installed_version':
-                    values['current'] if 'current' in values else '',
-                'latest_version': values['latest']
-            })
-
-    def update_cli(self, package_name=None):
-        cmd = "{} -g --progress=false update".format(self.cli)
-        if package_name:
-            cmd += " {}".format(package_name)
-        return self.bitbar_cli_format(cmd)
+            self.updates.append(update)
+
+    def update_cli_template(self):
+        return self.bitbar_cli_format(
+            "{} -g --progress=false update %s".format(self.cli))
 
     def update_all_cli(self):
-        return self.update_cli()
+        return self.bitbar_cli_format(
+            "{} -g --progress=false update".format(self.cli))
 
 
-class APM(PackageManager):
+class APM(CachedPackageManager, PackageManager):
 
-    cli = '/usr/local/bin/apm'
+    cli_name = 'apm'
 
-    @property
-    def name(self):
-        return "apm"
+    cache_fingerprint_paths = (os.path.expanduser('~/.atom/packages'), )
+
+    name = intern("apm")
 
     def sync(self):
-        output = self.run(self.cli, 'outdated', '--compatible', '--json')
-        if not output:
+        outdated = self.run_json(
+            self.cli, 'outdated', '--compatible', '--json')
+        if not outdated:
             return
 
-        for package in json.loads(output):
-            self.updates.append({
-                'name': package['name'],
-                'installed_version': package['version'],
-                'latest_version': package['latestVersion']
-            })
-
-    def update_cli(self, package_name=None):
-        cmd = "{} update --no-confirm".format(self.cli)
-        if package_name:
-            cmd += " {}".format(package_name)
-        return self.bitbar_cli_format(cmd)
+        for package in outdated:
+            # Skip entries not following the expected layout.
+            try:
+                update = Update(
+                    package['name'], package['version'],
+                    package['latestVersion'])
+            except (KeyError, TypeError):
+                continue
+            self.updates.append(update)
+
+    def update_cli_template(self):
+        return self.bitbar_cli_format(
+            "{} update --no-confirm %s".format(self.cli))
 
     def update_all_cli(self):
-        return self.update_cli()
+        return self.bitbar_cli_format(
+            "{} update --no-confirm".format(self.cli))
 
 
 class Gems(PackageManager):
-    HOMEBREW_PATH = '/usr/local/bin/gem'
     SYSTEM_PATH = '/usr/bin/gem'
 
-    def __init__(self):
-        super(Gems, self).__init__()
+    # Homebrew's gem takes precedence over the system one in the PATH.
+    cli_name = 'gem'
 
-        self.system = True
-        if os.path.exists(Gems.HOMEBREW_PATH):
-            self.system = False
-            self._cli = Gems.HOMEBREW_PATH
-        else:
-            self._cli = Gems.SYSTEM_PATH
+    name = intern("Ruby Gems")
 
-    @property
-    def cli(self):
-        return self._cli
-
-    @property
-    def name(self):
-        return "Ruby Gems"
+    def __init__(self):
+        super(Gems, self).__init__()
+        self.system = self.cli == Gems.SYSTEM_PATH
 
     def sync(self):
         """
@@ -497,69 +851,78 @@ class Gems(PackageManager):
         # outdated does not require sudo privileges on homebrew or system
         output = self.run(self.cli, 'outdated')
 
-        regexp = re.compile(r'(\S+) \((\S+) < (\S+)\)')
         for package in output.split('\n'):
             if not package:
                 continue
-            name, current_version, latest_version = regexp.match(
-                package).groups()
-            self.updates.append({
-                'name': name,
-                'installed_version': current_version,
-                'latest_version': latest_version
-            })
-
-    def update_cli(self, package_name=None):
+            # Skip lines not following the expected layout.
+            try:
+                name, versions = package.split(' (', 1)
+            except ValueError:
+                continue
+            current_version, sep, latest_version = versions.rstrip(
+                ')').partition(' < ')
+            if not sep:
+                continue
+            self.updates.append(Update(name, current_version, latest_version))
+
+    def _update_cmd(self):
         # installs require sudo on system ruby
-        cmd = "{}{} update".format(
+        return "{}{} update".format(
             '/usr/bin/sudo ' if self.system else '',
             self.cli)
-        if package_name:
-            cmd += " {}".format(package_name)
-        return self.bitbar_cli_format(cmd)
+
+    def update_cli_template(self):
+        return self.bitbar_cli_format("{} %s".format(self._update_cmd()))
 
     def update_all_cli(self):
-        return self.update_cli()
+        return self.bitbar_cli_format(self._update_cmd())
 
 
 class MAS(PackageManager):
 
-    cli = '/usr/local/bin/mas'
+    cli_name = 'mas'
+
+    name = intern("Mac AppStore")
 
     def __init__(self):
         super(MAS, self).__init__()
         self.map = {}
 
-    @property
-    def name(self):
-        return "Mac AppStore"
-
     def sync(self):
         output = self.run(self.cli, 'outdated')
         if not output:
             return
 
-        regexp = re.compile(r'(\d+) (.*) \((\S+) -> (\S+)\)$')
         for application in output.split('\n'):
             if not application:
                 continue
-            _id, name, installed_version, latest_version = regexp.match(
-                application).groups()
+            # Skip lines not following the expected layout.
+            try:
+                _id, infos = application.split(' ', 1)
+            except ValueError:
+                continue
+            name, sep, versions = infos.rpartition(' (')
+            installed_version, arrow, latest_version = versions.rstrip(
+                ')').partition(' -> ')
+            if not (_id.isdigit() and sep and arrow):
+                continue
             self.map[name] = _id
-            self.updates.append({
-                'name': name,
-                'latest_version': latest_version,
+            self.updates.append(Update(
+                name,
                 # Normalize unknown version. See: https://github.com/mas-cli
                 # /mas/commit/1859eaedf49f6a1ebefe8c8d71ec653732674341
-                'installed_version': (
-                    installed_version if installed_version != 'unknown'
-                    else '')})
+                installed_version if installed_version != 'unknown' else '',
+                latest_version))
 
     def update_cli(self, package_name):
-        if package_name not in self.map:
+        app_id = self.map.get(package_name)
+        if app_id is None:
             return None
-        cmd = "{} install {}".format(self.cli, self.map[package_name])
-        return self.bitbar_cli_format(cmd)
+        return super(MAS, self).update_cli(app_id)
+
+    def update_cli_template(self):
+        """ Install an application by its ID. """
+        return self.bitbar_cli_format("{} install %s".format(self.cli))
 
     def update_all_cli(self):
         cmd = "{} upgrade".format(self.cli)
@@ -578,40 +941,54 @@ def print_menu():
     # Filters-out inactive managers.
     managers = [m for m in managers if m.active]
 
-    # Sync all managers.
-    map(methodcaller('sync'), managers)
+    # Sync all managers in parallel. All the work is spent waiting on external
+    # CLIs, so threads are enough to overlap them.
+    if managers:
+        pool = ThreadPool(len(managers))
+        try:
+            pool.map(methodcaller('cached_sync'), managers)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Build the whole menu before writing it out in one go.
+    lines = []
 
-    # Print menu bar icon with number of available updates.
+    # Menu bar icon with number of available updates.
     total_updates = sum([len(m.updates) for m in managers])
     errors = [True for m in managers if m.error]
-    print(("↑{} {}| dropdown=false".format(
+    lines.append("↑{} {}| dropdown=false".format(
         total_updates,
-        "⚠️{}".format(len(errors)) if errors else ""
-    )).encode('utf-8'))
+        "⚠️{}".format(len(errors)) if errors else ""))
 
-    # Print a full detailed section for each manager.
+    # A full detailed section for each manager.
     for manager in managers:
-        print("---")
+        lines.append("---")
 
         if manager.error:
             for line in manager.error.strip().split("\n"):
-                print("{} | color=red".format(line))
+                lines.append("{} | color=red".format(line))
 
-        print("{} {} package{}".format(
-            len(manager.updates),
-            manager.name,
-            's' if len(manager.updates) != 1 else ''))
+        update_all = manager.update_all_cli()
+        count = len(manager.updates)
 
-        if manager.update_all_cli() and manager.updates:
-            print("Upgrade all | {} terminal=false refresh=true".format(
-                manager.update_all_cli()))
+        lines.append("{} {} package{}".format(
+            count, manager.name, 's' if count != 1 else ''))
 
-        for pkg_info in manager.updates:
-            print((
-                "{name} {installed_version} → {latest_version} | "
+        if update_all and count:
+            lines.append("Upgrade all | {} terminal=false refresh=true".format(
+                update_all))
+
+        for update in manager.updates:
+            lines.append(
+                "{u.name} {u.installed_version} → {u.latest_version} | "
                 "{cli} terminal=false refresh=true".format(
-                    cli=manager.update_cli(pkg_info['name']),
-                    **pkg_info)).encode('utf-8'))
+                    u=update, cli=manager.update_cli(update.name)))
+
+    # Python 2's stdout has no binary buffer but accepts encoded strings.
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout.write('\n'.join(lines).encode('utf-8') + b'\n')
+    stdout.flush()
 
 if __name__ == '__main__':
     import argparse